@@ -5,14 +5,21 @@ Using YOLOv8 for real-time kidney stone detection from CT scans
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from ultralytics import YOLO
 import cv2
 import numpy as np
 import base64
 import os
+import hmac
+import uuid
+import atexit
+import threading
 from datetime import datetime
+from functools import wraps
 import logging
 
+from history_store import HistoryStore, HISTORY_DB_PATH
+from inference_server import InferenceClient
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,10 +31,32 @@ CORS(app)  # Enable CORS for React frontend
 model = None
 MODEL_PATH = '../models/kidney_stone_yolov8.pt'
 
+# Split mode: when set, this process only decodes images and forwards pixels
+# through shared memory to inference_server.py, which holds the model.
+# A comma-separated list spreads workers across several inference servers.
+INFERENCE_SERVER = os.environ.get('INFERENCE_SERVER')
+inference_client = None
+inference_client_lock = threading.Lock()
+
+# Analysis history store (created lazily so each gunicorn worker gets its own writer thread)
+history_store = None
+history_store_lock = threading.Lock()
+
+# History endpoints expose every patient's records, so they stay disabled
+# unless a token is configured; clients send it as "Authorization: Bearer <token>"
+HISTORY_API_TOKEN = os.environ.get('HISTORY_API_TOKEN')
+
 def initialize_model():
     """Initialize the YOLO model"""
     global model
+    if INFERENCE_SERVER:
+        logger.info(f"Split mode: forwarding inference to {INFERENCE_SERVER}, not loading a local model")
+        return
+    
     try:
+        # Imported here so split-mode decode workers never load torch
+        from ultralytics import YOLO
+        
         if os.path.exists(MODEL_PATH):
             logger.info(f"Loading trained model from {MODEL_PATH}")
             model = YOLO(MODEL_PATH)
@@ -40,6 +69,43 @@ def initialize_model():
         logger.error(f"Error loading model: {e}")
         raise
 
+def get_inference_client():
+    """Return this process's connection to the inference server, opening it on first use"""
+    global inference_client
+    if inference_client is None:
+        with inference_client_lock:
+            if inference_client is None:
+                addresses = INFERENCE_SERVER.split(',')
+                inference_client = InferenceClient(addresses[os.getpid() % len(addresses)].strip())
+                atexit.register(inference_client.close)
+    return inference_client
+
+def run_detection(img, conf=0.25):
+    """
+    Run YOLO on a decoded image, locally or via the inference server
+    Returns a list of [x1, y1, x2, y2, confidence] in pixel coordinates
+    """
+    if INFERENCE_SERVER:
+        return get_inference_client().detect(img, conf=conf)
+    
+    results = model(img, conf=conf)
+    boxes = results[0].boxes
+    return [
+        [*box.xyxy[0].cpu().numpy().tolist(), float(box.conf[0].cpu().numpy())]
+        for box in boxes
+    ]
+
+def get_history_store():
+    """Return the analysis history store, opening it on first use"""
+    global history_store
+    if history_store is None:
+        with history_store_lock:
+            if history_store is None:
+                logger.info(f"Opening analysis history store at {HISTORY_DB_PATH}")
+                history_store = HistoryStore(HISTORY_DB_PATH)
+                atexit.register(history_store.close)
+    return history_store
+
 def decode_base64_image(base64_string):
     """Decode base64 image string to numpy array"""
     try:
@@ -135,9 +201,16 @@ def assess_image_quality(image):
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    if INFERENCE_SERVER:
+        # Split mode: the model lives in the inference server, so it must be answering
+        model_loaded = get_inference_client().ping()
+    else:
+        model_loaded = model is not None
+    
     return jsonify({
         'status': 'healthy',
-        'model_loaded': model is not None,
+        'model_loaded': model_loaded,
+        'inference_server': INFERENCE_SERVER,
         'timestamp': datetime.now().isoformat()
     })
 
@@ -168,14 +241,12 @@ def detect_stones():
         logger.info(f"Image quality: {image_quality}")
         
         # Run YOLO detection
-        results = model(img, conf=0.25)  # 25% confidence threshold
+        detections = run_detection(img, conf=0.25)  # 25% confidence threshold
         
         # Parse results
         detected_stones = []
-        for idx, box in enumerate(results[0].boxes):
-            # Get box coordinates
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-            confidence = float(box.conf[0].cpu().numpy()) * 100
+        for idx, (x1, y1, x2, y2, conf) in enumerate(detections):
+            confidence = conf * 100
             
             # Calculate box dimensions
             box_width = x2 - x1
@@ -237,7 +308,9 @@ def detect_stones():
             overall_confidence = 95  # High confidence if nothing detected
         
         # Prepare response
+        analysis_id = uuid.uuid4().hex
         response = {
+            'analysisId': analysis_id,
             'detectedStones': detected_stones,
             'totalCount': total_count,
             'imageType': 'CT Scan - Automated YOLOv8 Analysis',
@@ -254,6 +327,12 @@ def detect_stones():
         
         logger.info(f"Detection complete: {total_count} stones found with {overall_confidence:.1f}% confidence")
         
+        # Persist to history (queued, written in batches off the request path)
+        try:
+            get_history_store().record(analysis_id, patient_info, response)
+        except Exception as e:
+            logger.error(f"Failed to queue analysis for history: {e}")
+        
         return jsonify(response)
     
     except Exception as e:
@@ -263,10 +342,111 @@ def detect_stones():
             'message': str(e)
         }), 500
 
+def int_arg(name, default=None):
+    """Integer query parameter; ValueError instead of silently ignoring bad input"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer, got {value!r}")
+
+def date_arg(name, end_of_day=False):
+    """
+    ISO date/datetime query parameter normalized to the stored 'YYYY-MM-DD HH:MM:SS'
+    A bare date as an upper bound covers the whole day
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"'{name}' must be an ISO date or datetime, got {value!r}")
+    
+    if parsed.tzinfo is not None:
+        # analysisDate is stored in server local time
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    if end_of_day and len(value) == 10:
+        parsed = parsed.replace(hour=23, minute=59, second=59)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+def require_history_token(view):
+    """Reject history requests unless HISTORY_API_TOKEN is set and presented"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not HISTORY_API_TOKEN:
+            return jsonify({
+                'error': 'History API disabled',
+                'message': 'Set HISTORY_API_TOKEN on the server to enable it'
+            }), 403
+        
+        auth = request.headers.get('Authorization', '')
+        token = auth[len('Bearer '):] if auth.startswith('Bearer ') else ''
+        if not hmac.compare_digest(token.encode(), HISTORY_API_TOKEN.encode()):
+            return jsonify({'error': 'Unauthorized'}), 401
+        
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/history', methods=['GET'])
+@require_history_token
+def list_history():
+    """
+    Paginated analysis history, newest first
+    Query params: patientId, from, to (ISO date or datetime), minStones, maxStones, limit, cursor
+    """
+    try:
+        records, next_cursor = get_history_store().query(
+            patient_id=request.args.get('patientId'),
+            date_from=date_arg('from'),
+            date_to=date_arg('to', end_of_day=True),
+            min_stones=int_arg('minStones'),
+            max_stones=int_arg('maxStones'),
+            cursor=request.args.get('cursor') or None,
+            limit=int_arg('limit', 50)
+        )
+    except ValueError as e:
+        return jsonify({
+            'error': 'Invalid query parameter',
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error querying history: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': 'History query failed',
+            'message': str(e)
+        }), 500
+    
+    return jsonify({
+        'records': records,
+        'count': len(records),
+        'nextCursor': next_cursor
+    })
+
+@app.route('/history/<analysis_id>', methods=['GET'])
+@require_history_token
+def get_history_record(analysis_id):
+    """Fetch a single stored analysis by its analysisId"""
+    try:
+        record = get_history_store().get(analysis_id)
+    except Exception as e:
+        logger.error(f"Error fetching analysis {analysis_id}: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': 'History lookup failed',
+            'message': str(e)
+        }), 500
+    
+    if record is None:
+        return jsonify({'error': 'Analysis not found'}), 404
+    
+    return jsonify(record)
+
 @app.route('/model-info', methods=['GET'])
 def model_info():
     """Get information about the loaded model"""
-    if model is None:
+    if model is None and not INFERENCE_SERVER:
         return jsonify({'error': 'Model not loaded'}), 500
     
     return jsonify({
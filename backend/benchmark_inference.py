@@ -0,0 +1,208 @@
+"""
+Side-by-side Benchmark: Monolithic Workers vs Split Decode/Inference
+Compares N processes that each load YOLOv8 (like `gunicorn -w N app:app`)
+against N lightweight decode processes feeding shared-memory buffers to
+one or more inference_server.py processes.
+
+Reports throughput, total memory (PSS, so shared pages are not double
+counted) and throughput per GB of RAM for each architecture.
+
+Usage:
+  python benchmark_inference.py [workers] [servers] [images_per_worker]
+"""
+
+import os
+import sys
+import time
+import subprocess
+import multiprocessing as mp
+from pathlib import Path
+from multiprocessing.connection import Client
+
+MODEL_PATH = os.environ.get('MODEL_PATH', '../models/kidney_stone_yolov8.pt')
+IMAGE_DIR = Path('../data/images/train')
+ADDRESS_TEMPLATE = '/tmp/kidney_stone_benchmark_{}.sock'
+
+
+def load_encoded_images(limit=32):
+    """Read raw JPEG/PNG bytes so every worker pays the decode cost"""
+    paths = sorted(list(IMAGE_DIR.glob('*.jpg')) + list(IMAGE_DIR.glob('*.png')))[:limit]
+    return [p.read_bytes() for p in paths]
+
+
+def process_memory_mb(pid):
+    """Proportional set size of a process in MB (falls back to RSS)"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def monolithic_worker(images, iterations, ready, results, done):
+    """One full worker: decode, quality check and inference in-process"""
+    import cv2
+    import numpy as np
+    from ultralytics import YOLO
+    from app import assess_image_quality
+
+    model = YOLO(MODEL_PATH if os.path.exists(MODEL_PATH) else 'yolov8n.pt')
+    warmup = cv2.imdecode(np.frombuffer(images[0], np.uint8), cv2.IMREAD_COLOR)
+    model(warmup, conf=0.25, verbose=False)
+
+    ready.wait()
+    start = time.monotonic()
+    for i in range(iterations):
+        img = cv2.imdecode(np.frombuffer(images[i % len(images)], np.uint8), cv2.IMREAD_COLOR)
+        assess_image_quality(img)
+        model(img, conf=0.25, verbose=False)
+    results.put((os.getpid(), start, time.monotonic()))
+    done.wait()
+
+
+def decode_worker(address, images, iterations, ready, results, done):
+    """Lightweight worker: decode and quality check, inference via shared memory"""
+    import cv2
+    import numpy as np
+    from app import assess_image_quality
+    from inference_server import InferenceClient
+
+    client = InferenceClient(address)
+    warmup = cv2.imdecode(np.frombuffer(images[0], np.uint8), cv2.IMREAD_COLOR)
+    client.detect(warmup)
+
+    ready.wait()
+    start = time.monotonic()
+    for i in range(iterations):
+        img = cv2.imdecode(np.frombuffer(images[i % len(images)], np.uint8), cv2.IMREAD_COLOR)
+        assess_image_quality(img)
+        client.detect(img)
+    results.put((os.getpid(), start, time.monotonic()))
+    done.wait()
+    client.close()
+
+
+def wait_for_server(address, timeout=300):
+    from inference_server import get_authkey, parse_address
+
+    address = parse_address(address)
+    authkey = get_authkey(address)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            Client(address, authkey=authkey).close()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"Inference server at {address} did not start")
+
+
+def run_benchmark(name, targets, workers, iterations, extra_pids=()):
+    """Start worker processes, time them together and sample their memory"""
+    ctx = mp.get_context('spawn')
+    ready = ctx.Barrier(workers + 1)
+    done = ctx.Event()
+    results = ctx.Queue()
+
+    procs = []
+    for i in range(workers):
+        target, args = targets(i)
+        p = ctx.Process(target=target, args=(*args, iterations, ready, results, done))
+        p.start()
+        procs.append(p)
+
+    ready.wait()
+    timings = [results.get() for _ in procs]
+
+    # Sample while every process is still alive and warm
+    memory_mb = sum(process_memory_mb(p.pid) for p in procs)
+    memory_mb += sum(process_memory_mb(pid) for pid in extra_pids)
+
+    done.set()
+    for p in procs:
+        p.join()
+
+    elapsed = max(t[2] for t in timings) - min(t[1] for t in timings)
+    throughput = workers * iterations / elapsed
+    return {
+        'name': name,
+        'throughput': throughput,
+        'memory_mb': memory_mb,
+        'per_gb': throughput / (memory_mb / 1024) if memory_mb else 0.0,
+    }
+
+
+def main(workers=4, servers=1, iterations=50):
+    images = load_encoded_images()
+    if not images:
+        print(f"\n❌ No images found in {IMAGE_DIR}")
+        return
+
+    print("="*60)
+    print("Inference Architecture Benchmark")
+    print("="*60)
+    print(f"\n📊 Configuration:")
+    print(f"   - Workers: {workers}")
+    print(f"   - Inference servers (split mode): {servers}")
+    print(f"   - Images per worker: {iterations}")
+    print(f"   - Model: {MODEL_PATH if os.path.exists(MODEL_PATH) else 'yolov8n.pt'}")
+
+    print(f"\n🚀 Running monolithic workers ({workers} model copies)...")
+    monolithic = run_benchmark(
+        f'Monolithic ({workers} workers)',
+        lambda i: (monolithic_worker, (images,)),
+        workers, iterations
+    )
+
+    print(f"\n🚀 Running split mode ({workers} decode workers, {servers} inference server(s))...")
+    # Launched as separate programs, as in deployment, rather than children
+    # sharing this process's multiprocessing resource tracker
+    addresses = [ADDRESS_TEMPLATE.format(i) for i in range(servers)]
+    server_procs = [
+        subprocess.Popen(
+            [sys.executable, 'inference_server.py', 'serve', address],
+            env={**os.environ, 'MODEL_PATH': MODEL_PATH},
+            stdout=subprocess.DEVNULL
+        )
+        for address in addresses
+    ]
+    try:
+        for address in addresses:
+            wait_for_server(address)
+        split = run_benchmark(
+            f'Split ({workers} decode + {servers} inference)',
+            lambda i: (decode_worker, (addresses[i % servers], images)),
+            workers, iterations,
+            extra_pids=[p.pid for p in server_procs]
+        )
+    finally:
+        for p in server_procs:
+            p.terminate()
+            p.wait()
+        for address in addresses:
+            if os.path.exists(address):
+                os.unlink(address)
+
+    print("\n" + "="*60)
+    print(f"{'Architecture':<34}{'img/s':>8}{'RAM MB':>10}{'img/s/GB':>10}")
+    print("-"*62)
+    for r in (monolithic, split):
+        print(f"{r['name']:<34}{r['throughput']:>8.1f}{r['memory_mb']:>10.0f}{r['per_gb']:>10.2f}")
+
+    if monolithic['per_gb']:
+        print(f"\n📈 Split mode throughput per GB: {split['per_gb'] / monolithic['per_gb']:.2f}x monolithic")
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:4]]
+    main(*args)
@@ -0,0 +1,269 @@
+"""
+Analysis History Store for Kidney Stone Detection
+Persists /detect results in an embedded SQLite database (WAL mode)
+so prior scans can be queried server-side by patient, date and stone count
+"""
+
+import base64
+import heapq
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DB_PATH = os.environ.get('HISTORY_DB_PATH', '../data/history.db')
+
+MAX_PAGE_SIZE = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    analysis_id TEXT NOT NULL UNIQUE,
+    patient_id TEXT,
+    patient_name TEXT,
+    analysis_date TEXT NOT NULL,
+    total_count INTEGER NOT NULL,
+    image_quality TEXT,
+    analysis_confidence REAL,
+    patient_info TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_date ON analyses (analysis_date, id);
+CREATE INDEX IF NOT EXISTS idx_analyses_patient_date ON analyses (patient_id, analysis_date, id);
+CREATE INDEX IF NOT EXISTS idx_analyses_count_date ON analyses (total_count, analysis_date, id);
+"""
+
+INSERT_SQL = """
+INSERT OR IGNORE INTO analyses (
+    analysis_id, patient_id, patient_name, analysis_date, total_count,
+    image_quality, analysis_confidence, patient_info, result
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class HistoryStore:
+    """
+    SQLite-backed store of detection results
+
+    Writes are queued and flushed in batches by a background thread so
+    they never block the request path. Reads page newest first with a
+    keyset cursor on (analysis_date, id), and every filter is served by an
+    index in that order, so fetching a page costs the same however large
+    the history grows.
+    """
+
+    def __init__(self, db_path=HISTORY_DB_PATH, batch_size=100, flush_interval=0.5):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _reader(self):
+        """Per-thread read connection (Flask serves requests on many threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def record(self, analysis_id, patient_info, result):
+        """Queue a detection result for persistence (non-blocking)"""
+        patient_info = patient_info or {}
+        self._queue.put((
+            analysis_id,
+            patient_info.get('patientId') or None,
+            patient_info.get('name') or None,
+            result['analysisDate'],
+            result['totalCount'],
+            result.get('imageQuality'),
+            result.get('analysisConfidence'),
+            json.dumps(patient_info),
+            json.dumps(result),
+        ))
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while not (self._stop.is_set() and self._queue.empty()):
+                batch = self._drain()
+                if batch:
+                    self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _drain(self):
+        """Collect up to batch_size rows, waiting at most flush_interval"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.task_done()
+                break
+            batch.append(item)
+        return batch
+
+    def _write_batch(self, conn, batch):
+        try:
+            with conn:
+                conn.executemany(INSERT_SQL, batch)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to persist {len(batch)} analyses: {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued record has been written"""
+        self._queue.join()
+
+    def close(self):
+        """Flush pending writes and stop the writer thread"""
+        self._stop.set()
+        self._queue.put(None)
+        self._writer.join(timeout=10)
+
+    def get(self, analysis_id):
+        """Return a single stored analysis, or None"""
+        row = self._reader().execute(
+            'SELECT * FROM analyses WHERE analysis_id = ?', (analysis_id,)
+        ).fetchone()
+        return _row_to_record(row) if row else None
+
+    def query(self, patient_id=None, date_from=None, date_to=None,
+              min_stones=None, max_stones=None, cursor=None, limit=50):
+        """
+        Page through stored analyses, newest first
+
+        date_from and date_to are inclusive 'YYYY-MM-DD HH:MM:SS' strings,
+        the format analysisDate is stored in. Pass the returned next_cursor
+        back as cursor to fetch the following page; it is None on the last
+        page.
+        Raises ValueError for a malformed cursor.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+        clauses = []
+        params = []
+        if date_from is not None:
+            clauses.append('analysis_date >= ?')
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append('analysis_date <= ?')
+            params.append(date_to)
+        if cursor is not None:
+            clauses.append('(analysis_date, id) < (?, ?)')
+            params.extend(decode_cursor(cursor))
+
+        if patient_id is not None:
+            # One patient's history is small; stone counts filter the index scan
+            clauses.insert(0, 'patient_id = ?')
+            params.insert(0, patient_id)
+            if min_stones is not None:
+                clauses.append('total_count >= ?')
+                params.append(int(min_stones))
+            if max_stones is not None:
+                clauses.append('total_count <= ?')
+                params.append(int(max_stones))
+            rows = self._page('idx_analyses_patient_date', clauses, params, limit)
+        elif min_stones is not None or max_stones is not None:
+            # A range on total_count can't also deliver rows in date order, so
+            # read each matching count value in date order and merge the pages
+            pages = [
+                self._page('idx_analyses_count_date', ['total_count = ?'] + clauses,
+                           [value] + params, limit)
+                for value in self._count_values(min_stones, max_stones)
+            ]
+            rows = list(heapq.merge(*pages, key=_sort_key, reverse=True))[:limit + 1]
+        else:
+            rows = self._page('idx_analyses_date', clauses, params, limit)
+
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+
+        return [_row_to_record(row) for row in rows[:limit]], next_cursor
+
+    def _page(self, index, clauses, params, limit):
+        """Up to limit + 1 rows, newest first, read in order from one index"""
+        sql = f'SELECT * FROM analyses INDEXED BY {index}'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY analysis_date DESC, id DESC LIMIT ?'
+        return self._reader().execute(sql, params + [limit + 1]).fetchall()
+
+    def _count_values(self, min_stones=None, max_stones=None):
+        """Distinct stone counts in range, one index seek per value"""
+        # Keep a single lower bound per query so SQLite can seek straight to
+        # the minimum instead of scanning the range
+        sql = 'SELECT MIN(total_count) FROM analyses WHERE total_count >= ?'
+        upper = []
+        if max_stones is not None:
+            sql += ' AND total_count <= ?'
+            upper = [int(max_stones)]
+
+        conn = self._reader()
+        values = []
+        lower = int(min_stones) if min_stones is not None else -1
+        value = conn.execute(sql, [lower] + upper).fetchone()[0]
+        while value is not None:
+            values.append(value)
+            value = conn.execute(sql, [value + 1] + upper).fetchone()[0]
+        return values
+
+
+def _sort_key(row):
+    return (row['analysis_date'], row['id'])
+
+
+def encode_cursor(row):
+    """Opaque, URL-safe cursor for the position after row"""
+    raw = f"{row['id']}|{row['analysis_date']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor -> (analysis_date, id); ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        row_id, analysis_date = raw.split('|', 1)
+        return analysis_date, int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def _row_to_record(row):
+    return {
+        'analysisId': row['analysis_id'],
+        'patientInfo': json.loads(row['patient_info']),
+        'results': json.loads(row['result']),
+    }
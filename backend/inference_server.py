@@ -0,0 +1,249 @@
+"""
+Shared-Memory Inference Server for Kidney Stone Detection
+Holds a single YOLOv8 model copy and serves detections to lightweight
+decode workers (e.g. gunicorn workers running app.py with INFERENCE_SERVER set)
+
+Decode workers parse requests and cv2.imdecode the image into a shared
+memory buffer; only the buffer name and shape cross the socket, so pixels
+are never pickled or sent through it.
+
+Usage:
+  python inference_server.py serve [address]
+  INFERENCE_SERVER=/tmp/kidney_stone_inference.sock gunicorn -w 8 app:app
+  (host:port addresses also need INFERENCE_AUTHKEY set on both sides)
+"""
+
+import logging
+import os
+import threading
+from multiprocessing import AuthenticationError, resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = '/tmp/kidney_stone_inference.sock'
+
+
+def parse_address(address):
+    """'host:port' -> (host, port); anything else is a unix socket path"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def get_authkey(address):
+    """
+    Shared secret from INFERENCE_AUTHKEY
+    multiprocessing connections unpickle what they receive, so TCP
+    addresses are refused without a key; unix sockets are instead
+    protected by owner-only file permissions.
+    """
+    authkey = os.environ.get('INFERENCE_AUTHKEY')
+    if authkey:
+        return authkey.encode()
+    if isinstance(address, tuple):
+        raise ValueError(
+            f"INFERENCE_AUTHKEY must be set to use a TCP inference server ({address[0]}:{address[1]})"
+        )
+    return None
+
+
+def attach_shared_memory(name):
+    """Attach to a segment owned by another process without taking ownership"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: stop the resource tracker unlinking the client's segment
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def close_shared_memory(shm):
+    """Unmap a segment, logging rather than raising if it is still referenced"""
+    try:
+        shm.close()
+    except BufferError as e:
+        logger.warning(f"Could not unmap shared memory {shm.name}: {e}")
+
+
+class InferenceServer:
+    """Serve YOLO detections over a multiprocessing connection"""
+
+    def __init__(self, model_path, address=DEFAULT_ADDRESS):
+        from ultralytics import YOLO
+
+        self.address = parse_address(address)
+        self.authkey = get_authkey(self.address)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+        if os.path.exists(model_path):
+            logger.info(f"Loading trained model from {model_path}")
+            self.model = YOLO(model_path)
+        else:
+            logger.warning("Trained model not found, using pre-trained YOLOv8n")
+            self.model = YOLO('yolov8n.pt')
+        self.model_lock = threading.Lock()
+
+    def serve_forever(self):
+        # Create unix sockets owner-only (0600) so other local users can't connect
+        old_umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, authkey=self.authkey)
+        finally:
+            os.umask(old_umask)
+
+        with listener:
+            logger.info(f"Inference server ready on {self.address}")
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        """Serve one decode worker until it disconnects"""
+        segments = {}
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+
+                if message == 'ping':
+                    conn.send(('ok', None))
+                    continue
+
+                try:
+                    shm_name, shape, conf = message
+                    shm = segments.get(shm_name)
+                    if shm is None:
+                        # Client replaced its buffer; drop the stale mapping
+                        for old in segments.values():
+                            close_shared_memory(old)
+                        segments.clear()
+                        shm = segments[shm_name] = attach_shared_memory(shm_name)
+
+                    # Copy out of the segment: ultralytics keeps views of its input
+                    # (predictor batch, results orig_img), which would pin the
+                    # mapping and make it impossible to unmap when the client
+                    # replaces its buffer
+                    img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+                    with self.model_lock:
+                        results = self.model(img, conf=conf, verbose=False)
+
+                    boxes = results[0].boxes
+                    detections = np.hstack([
+                        boxes.xyxy.cpu().numpy(),
+                        boxes.conf.cpu().numpy().reshape(-1, 1)
+                    ]).tolist()
+                    conn.send(('ok', detections))
+                except Exception as e:
+                    logger.error(f"Inference failed: {e}", exc_info=True)
+                    conn.send(('error', str(e)))
+        finally:
+            for shm in segments.values():
+                close_shared_memory(shm)
+            conn.close()
+
+
+class InferenceClient:
+    """
+    Decode-worker side of the inference server
+
+    Keeps one shared memory buffer per client, grown on demand, so steady
+    state requests cost one copy of the decoded image and no allocation.
+    Thread-safe: concurrent calls share the buffer and connection and are
+    serialized, so one client per process is enough.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS):
+        self.address = parse_address(address)
+        self.authkey = get_authkey(self.address)
+        self.conn = None
+        self.shm = None
+        self.lock = threading.Lock()
+
+    def _ensure_buffer(self, nbytes):
+        if self.shm is not None and self.shm.size >= nbytes:
+            return
+        self._release_buffer()
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+
+    def _release_buffer(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def detect(self, img, conf=0.25):
+        """
+        Run detection on a decoded BGR image
+        Returns a list of [x1, y1, x2, y2, confidence] in pixel coordinates
+        """
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        with self.lock:
+            self._ensure_buffer(img.nbytes)
+            np.ndarray(img.shape, dtype=np.uint8, buffer=self.shm.buf)[...] = img
+
+            if self.conn is None:
+                self.conn = Client(self.address, authkey=self.authkey)
+            try:
+                self.conn.send((self.shm.name, img.shape, conf))
+                status, payload = self.conn.recv()
+            except (EOFError, OSError):
+                # Server restarted; reconnect on next call
+                self._drop_connection()
+                raise
+
+        if status != 'ok':
+            raise RuntimeError(f"Inference server error: {payload}")
+        return payload
+
+    def ping(self, timeout=2.0):
+        """True if the inference server is reachable and answering"""
+        with self.lock:
+            try:
+                if self.conn is None:
+                    self.conn = Client(self.address, authkey=self.authkey)
+                self.conn.send('ping')
+                if not self.conn.poll(timeout):
+                    # A late reply would be read as the next detection's result
+                    self._drop_connection()
+                    return False
+                status, _ = self.conn.recv()
+                return status == 'ok'
+            except (EOFError, OSError, AuthenticationError):
+                self._drop_connection()
+                return False
+
+    def _drop_connection(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+
+    def close(self):
+        with self.lock:
+            self._drop_connection()
+            self._release_buffer()
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        address = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('INFERENCE_SERVER', DEFAULT_ADDRESS)
+        model_path = os.environ.get('MODEL_PATH', '../models/kidney_stone_yolov8.pt')
+        InferenceServer(model_path, address).serve_forever()
+    else:
+        print("Usage:")
+        print("  python inference_server.py serve [address]  - Start inference server")
+        print(f"\nDefault address: {DEFAULT_ADDRESS} (or host:port)")
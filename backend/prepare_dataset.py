@@ -4,10 +4,16 @@ This script helps prepare and validate your dataset for YOLOv8 training
 """
 
 import os
+import json
 import yaml
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import shutil
 
+HASH_INDEX_PATH = Path('../data/phash_index.json')
+DUPLICATES_DIR = Path('../data/duplicates')
+
 def create_dataset_structure():
     """Create proper directory structure for YOLOv8 dataset"""
     
@@ -120,6 +126,202 @@ def validate_dataset():
     
     return total_images > 0
 
+def dhash(image_path, hash_size=8):
+    """64-bit difference hash: robust to re-encoding, resizing and small intensity shifts"""
+    from PIL import Image
+    
+    with Image.open(image_path) as img:
+        # Let the JPEG decoder downscale while decoding; much faster on large scans
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        pixels = list(img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+def _safe_dhash(path):
+    try:
+        return dhash(path)
+    except Exception:
+        return None
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def build_hash_index(base_dir=Path('../data'), index_path=HASH_INDEX_PATH):
+    """
+    Perceptual hashes for every image in every split
+    Hashes are cached on disk keyed by size and mtime, so only new or
+    modified images are hashed again; hashing runs in parallel.
+    Returns {relative_path: (split, hash)}
+    """
+    cache = {}
+    if index_path.exists():
+        with open(index_path) as f:
+            cache = json.load(f)
+    
+    entries = {}
+    to_hash = []
+    for split in ['train', 'val', 'test']:
+        img_dir = base_dir / 'images' / split
+        for img in list(img_dir.glob('*.jpg')) + list(img_dir.glob('*.png')):
+            key = img.relative_to(base_dir).as_posix()
+            stat = img.stat()
+            cached = cache.get(key)
+            if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                entries[key] = cached
+            else:
+                entries[key] = {'split': split, 'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': None}
+                to_hash.append(key)
+    
+    if to_hash:
+        print(f"\n🔍 Hashing {len(to_hash)} new or modified images ({len(entries) - len(to_hash)} cached)...")
+        with ProcessPoolExecutor() as pool:
+            paths = [str(base_dir / key) for key in to_hash]
+            for key, value in zip(to_hash, pool.map(_safe_dhash, paths, chunksize=64)):
+                entries[key]['hash'] = None if value is None else format(value, '016x')
+    
+    if to_hash or set(cache) != set(entries):
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(index_path, 'w') as f:
+            json.dump(entries, f)
+    
+    unreadable = [key for key, entry in entries.items() if entry['hash'] is None]
+    if unreadable:
+        print(f"  ⚠️  {len(unreadable)} images could not be read")
+    
+    return {
+        key: (entry['split'], int(entry['hash'], 16))
+        for key, entry in entries.items() if entry['hash'] is not None
+    }
+
+def find_near_duplicates(index, threshold=4):
+    """
+    All pairs of images within `threshold` bits Hamming distance
+    The 64-bit hash is split into threshold+1 bands; by the pigeonhole
+    principle any pair within the threshold matches exactly on at least
+    one band, so only images sharing a band bucket are compared.
+    """
+    num_bands = threshold + 1
+    widths = [64 // num_bands + (1 if i < 64 % num_bands else 0) for i in range(num_bands)]
+    
+    buckets = defaultdict(list)
+    keys = list(index)
+    for i, key in enumerate(keys):
+        value = index[key][1]
+        shift = 0
+        for band, width in enumerate(widths):
+            buckets[(band, (value >> shift) & ((1 << width) - 1))].append(i)
+            shift += width
+    
+    pairs = set()
+    for members in buckets.values():
+        for a_pos, a in enumerate(members):
+            a_hash = index[keys[a]][1]
+            for b in members[a_pos + 1:]:
+                if hamming(a_hash, index[keys[b]][1]) <= threshold:
+                    pairs.add((min(a, b), max(a, b)))
+    
+    return [(keys[a], keys[b]) for a, b in sorted(pairs)]
+
+def select_duplicates(index, pairs, split_order):
+    """
+    Greedy representative set over near-duplicate pairs
+    Walks images train -> val -> test and keeps each one unless it is
+    within the threshold of an image already kept, so a chain A~B~C~D
+    with A and D far apart keeps A and C.
+    Returns {removed_image: kept_image_it_duplicates}
+    """
+    neighbours = defaultdict(set)
+    for a, b in pairs:
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+    
+    def order(key):
+        return (split_order[index[key][0]], key)
+    
+    kept = set()
+    removed = {}
+    for key in sorted(neighbours, key=order):
+        matches = [other for other in neighbours[key] if other in kept]
+        if matches:
+            # A kept copy in an earlier split makes this a leak, not just a duplicate
+            removed[key] = min(matches, key=lambda other: (
+                order(other)[0], hamming(index[key][1], index[other][1]), other
+            ))
+        else:
+            kept.add(key)
+    return removed
+
+def _move_to_duplicates(key, base_dir=Path('../data')):
+    """Move an image and its label aside instead of deleting them"""
+    img = base_dir / key
+    label = base_dir / key.replace('images/', 'labels/', 1)
+    label = label.with_suffix('.txt')
+    
+    for src in (img, label):
+        if src.exists():
+            dst = DUPLICATES_DIR / src.relative_to(base_dir)
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(src), str(dst))
+
+def check_duplicates(threshold=4, remove=False):
+    """Report near-duplicates within each split and leaks across splits"""
+    
+    print("\n" + "="*60)
+    print("Near-Duplicate & Leakage Check")
+    print("="*60)
+    
+    index = build_hash_index()
+    print(f"\n📊 Indexed {len(index)} images (threshold: {threshold} bits)")
+    
+    pairs = find_near_duplicates(index, threshold)
+    split_order = {'train': 0, 'val': 1, 'test': 2}
+    
+    removed = select_duplicates(index, pairs, split_order)
+    within = {key: kept for key, kept in removed.items() if index[key][0] == index[kept][0]}
+    leaks = {key: kept for key, kept in removed.items() if index[key][0] != index[kept][0]}
+    to_remove = set(removed)
+    
+    print(f"\nNear-duplicate pairs: {len(pairs)}")
+    
+    # Within a split keep one representative per cluster of close images
+    print(f"\nWithin-split near-duplicates: {len(within)} redundant images")
+    for split in ['train', 'val', 'test']:
+        count = sum(1 for key in within if index[key][0] == split)
+        if count:
+            print(f"  {split.upper()}: {count}")
+    
+    # Across splits drop the copy in the later (evaluation) split
+    print(f"\nCross-split leaks: {len(leaks)} images")
+    leak_counts = defaultdict(int)
+    for key, kept in leaks.items():
+        leak_counts[f"{index[kept][0]} -> {index[key][0]}"] += 1
+    for direction, count in sorted(leak_counts.items()):
+        print(f"  {direction}: {count}")
+    
+    leak_list = sorted(leaks.items())
+    for key, kept in leak_list[:10]:
+        distance = hamming(index[key][1], index[kept][1])
+        print(f"  ⚠️  {key} ~ {kept} (distance {distance})")
+    if len(leak_list) > 10:
+        print(f"  ... and {len(leak_list) - 10} more")
+    
+    if not to_remove:
+        print("\n✅ No near-duplicates or leaks found")
+        return
+    
+    if remove:
+        for key in sorted(to_remove):
+            _move_to_duplicates(key)
+        print(f"\n🧹 Moved {len(to_remove)} images (and labels) to {DUPLICATES_DIR}")
+    else:
+        print(f"\n💡 {len(to_remove)} images would be removed. Run with --remove to move them to {DUPLICATES_DIR}")
+
 def download_sample_dataset():
     """Instructions for downloading sample kidney stone datasets"""
     
@@ -201,13 +403,18 @@ if __name__ == '__main__':
             validate_dataset()
         elif command == 'download':
             download_sample_dataset()
+        elif command == 'duplicates':
+            threshold = next((int(arg) for arg in sys.argv[2:] if arg.isdigit()), 4)
+            check_duplicates(threshold=threshold, remove='--remove' in sys.argv)
         else:
             print(f"Unknown command: {command}")
-            print("Usage: python prepare_dataset.py [init|validate|download]")
+            print("Usage: python prepare_dataset.py [init|validate|duplicates|download]")
     else:
         print("\nUsage:")
         print("  python prepare_dataset.py init      - Create dataset structure")
         print("  python prepare_dataset.py validate  - Validate dataset")
+        print("  python prepare_dataset.py duplicates [threshold] [--remove]")
+        print("                                      - Find near-duplicates and train/val/test leaks")
         print("  python prepare_dataset.py download  - Show dataset sources")
         print("\nRunning init by default...")
         create_dataset_structure()
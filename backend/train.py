@@ -5,8 +5,15 @@ This script trains a YOLOv8 model on kidney stone CT scan dataset
 
 from ultralytics import YOLO
 import os
+import json
+import random
+import shutil
+import hashlib
+import yaml
 import torch
 from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 CONFIG = {
@@ -18,6 +25,14 @@ CONFIG = {
     'patience': 50,  # Early stopping patience
     'save_dir': '../models',
     'device': 'cpu',  # Will auto-detect GPU below
+    
+    # Incremental updates (python train.py update)
+    'production_model': '../models/kidney_stone_yolov8.pt',
+    'manifest_path': '../models/dataset_manifest.json',
+    'update_epochs': 15,
+    'update_lr0': 0.001,      # Lower LR so fine-tuning doesn't wipe out prior training
+    'replay_ratio': 2.0,      # Old images replayed per new/changed image
+    'update_tolerance': 0.0,  # Max allowed metric drop before promotion is refused
 }
 
 # Auto-detect GPU/CPU
@@ -63,6 +78,10 @@ def train_model():
     else:
         print(f"\n⏱️  Estimated time: 10-15 minutes")
     
+    # Snapshot the data this run trains on; it becomes the production
+    # manifest only when these weights are promoted
+    run_manifest = build_manifest()
+    
     # Train model
     print(f"\n🚀 Starting training...\n")
     
@@ -117,10 +136,12 @@ def train_model():
         print(f"   - Recall: {results.results_dict['metrics/recall(B)']:.4f}")
         
         # Model location
-        best_model_path = Path(CONFIG['save_dir']) / 'kidney_stone_yolov8' / 'weights' / 'best.pt'
+        run_dir = Path(CONFIG['save_dir']) / 'kidney_stone_yolov8'
+        best_model_path = run_dir / 'weights' / 'best.pt'
+        save_manifest(run_manifest, run_dir / 'dataset_manifest.json')
         print(f"\n💾 Best model saved to: {best_model_path}")
         print(f"\n📋 To deploy this model:")
-        print(f"   1. Copy: copy {best_model_path} {CONFIG['save_dir']}\\kidney_stone_yolov8.pt")
+        print(f"   1. Promote: python train.py promote")
         print(f"   2. Restart backend: python app.py")
         print(f"   3. Test in your web app!")
         
@@ -153,6 +174,298 @@ def validate_model(model_path='../models/kidney_stone_yolov8.pt'):
     print(f"   - mAP50-95: {results.box.map:.4f}")
     print(f"   - Precision: {results.box.mp:.4f}")
     print(f"   - Recall: {results.box.mr:.4f}")
+    
+    return results
+
+def load_data_config(data_yaml=None):
+    """Load dataset YAML and resolve its root directory"""
+    data_yaml = Path(data_yaml or CONFIG['data_yaml'])
+    with open(data_yaml) as f:
+        data_config = yaml.safe_load(f)
+    
+    root = Path(data_config.get('path') or data_yaml.parent)
+    if not root.is_absolute():
+        root = data_yaml.parent / root
+    if not root.exists():
+        # Config written on another machine; fall back to the YAML's directory
+        root = data_yaml.parent
+    
+    return data_config, root
+
+def hash_file(path):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_manifest():
+    """
+    Content hashes of every training image and its label
+    Keyed by path relative to the dataset root, so moving or re-cloning
+    the repo doesn't make every image look new
+    Returns {relative_image_path: {'image': sha256, 'label': sha256 or None}}
+    """
+    data_config, root = load_data_config()
+    img_dir = root / data_config['train']
+    lbl_dir = root / str(data_config['train']).replace('images', 'labels', 1)
+    
+    images = sorted(list(img_dir.glob('*.jpg')) + list(img_dir.glob('*.png')))
+    labels = [lbl_dir / f"{img.stem}.txt" for img in images]
+    
+    with ThreadPoolExecutor() as pool:
+        image_hashes = list(pool.map(hash_file, images))
+        label_hashes = list(pool.map(lambda p: hash_file(p) if p.exists() else None, labels))
+    
+    return {
+        img.relative_to(root).as_posix(): {'image': img_hash, 'label': lbl_hash}
+        for img, img_hash, lbl_hash in zip(images, image_hashes, label_hashes)
+    }
+
+def split_images(data_config, root, split):
+    """
+    Images in a dataset split, as paths relative to the dataset root
+    Accepts the forms YOLO does: a directory, a .txt list of images,
+    or a list of either
+    """
+    entries = data_config.get(split) or []
+    if not isinstance(entries, list):
+        entries = [entries]
+    
+    images = set()
+    for entry in entries:
+        path = Path(entry)
+        if not path.is_absolute():
+            path = root / path
+        if path.suffix == '.txt' and path.is_file():
+            listed = [Path(line.strip()) for line in path.read_text().splitlines() if line.strip()]
+            paths = [p if p.is_absolute() else root / p for p in listed]
+        else:
+            paths = list(path.glob('*.jpg')) + list(path.glob('*.png'))
+        
+        for img in paths:
+            img = img.resolve()
+            try:
+                images.add(img.relative_to(root.resolve()).as_posix())
+            except ValueError:
+                images.add(str(img))
+    return images
+
+def load_manifest(manifest_path=None):
+    """Load the manifest of the data the production model was trained on, or None"""
+    manifest_path = manifest_path or CONFIG['manifest_path']
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)['files']
+
+def save_manifest(files, manifest_path=None):
+    manifest_path = manifest_path or CONFIG['manifest_path']
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(), 'files': files}, f, indent=2)
+
+def promote_model(run_name='kidney_stone_yolov8'):
+    """Deploy a full training run's best weights along with its data manifest"""
+    
+    print("="*60)
+    print("Promote Trained Model")
+    print("="*60)
+    
+    run_dir = Path(CONFIG['save_dir']) / run_name
+    best_model_path = run_dir / 'weights' / 'best.pt'
+    if not best_model_path.exists():
+        print(f"\n❌ Trained weights not found at {best_model_path}")
+        print("   Run a full training first: python train.py train")
+        return
+    
+    production_model = CONFIG['production_model']
+    if os.path.exists(production_model):
+        backup = Path(production_model).with_suffix('.prev.pt')
+        shutil.copy(production_model, backup)
+        print(f"\n📦 Previous weights backed up to {backup}")
+    shutil.copy(best_model_path, production_model)
+    
+    run_manifest = load_manifest(run_dir / 'dataset_manifest.json')
+    if run_manifest is not None:
+        save_manifest(run_manifest)
+    elif os.path.exists(CONFIG['manifest_path']):
+        # Unknown training data; a stale manifest would hide images from updates
+        os.remove(CONFIG['manifest_path'])
+        print(f"\n⚠️  Run has no dataset manifest; removed {CONFIG['manifest_path']}")
+    
+    print(f"\n✅ Promoted {best_model_path} to {production_model}")
+    print(f"   Restart backend to load the new model: python app.py")
+
+def update_model(baseline=False):
+    """
+    Fine-tune production weights on new or changed training data
+    Replays a sample of previously seen images to avoid forgetting and
+    only promotes the result if validation metrics do not regress
+    
+    baseline=True only records the current training data as what the
+    production model was trained on
+    """
+    
+    print("="*60)
+    print("YOLOv8 Incremental Model Update")
+    print("="*60)
+    
+    production_model = CONFIG['production_model']
+    if not os.path.exists(production_model):
+        print(f"\n❌ Production model not found at {production_model}")
+        print("   Run a full training first: python train.py train")
+        return
+    
+    if not os.path.exists(CONFIG['data_yaml']):
+        print(f"\n❌ Error: Dataset configuration not found at {CONFIG['data_yaml']}")
+        return
+    
+    print(f"\n🔍 Hashing training data...")
+    current = build_manifest()
+    previous = load_manifest()
+    
+    if baseline:
+        save_manifest(current)
+        print(f"\n✅ Recorded the current {len(current)} training images as the baseline for {production_model}")
+        print(f"   Add new images/labels and run: python train.py update")
+        return
+    
+    if previous is None:
+        # Adopting the current tree here would mark unseen scans as trained
+        print(f"\n❌ No manifest records which images {production_model} was trained on.")
+        print(f"   If it was trained on exactly the current training data, run:")
+        print(f"      python train.py update --baseline")
+        print(f"   then add new scans and run update again. Otherwise retrain and promote:")
+        print(f"      python train.py train && python train.py promote")
+        return
+    
+    changed = [path for path, hashes in current.items() if previous.get(path) != hashes]
+    unchanged = [path for path, hashes in current.items() if previous.get(path) == hashes]
+    
+    print(f"\n📊 Dataset changes since last run:")
+    print(f"   - New or changed images: {len(changed)}")
+    print(f"   - Unchanged images: {len(unchanged)}")
+    print(f"   - Removed images: {len(set(previous) - set(current))}")
+    
+    if not changed:
+        print(f"\n✅ No new training data. Production model is up to date.")
+        return
+    
+    # The promotion gate is only meaningful on images the model never trains on
+    data_config, root = load_data_config()
+    val_images = split_images(data_config, root, 'val')
+    overlap = val_images & set(current)
+    if not val_images or overlap:
+        print("\n" + "!"*60)
+        if overlap:
+            print(f"❌ Validation split shares {len(overlap)} of {len(val_images)} images with training data")
+            print(f"   (val: {data_config.get('val')}, train: {data_config.get('train')})")
+            print(f"   The no-regression check would score the candidate on images it")
+            print(f"   was fine-tuned on and let regressions through. Refusing to update.")
+        else:
+            print(f"❌ Validation split '{data_config.get('val')}' has no images. Refusing to update.")
+        print("!"*60)
+        print(f"\n   Move held-out scans to data/images/val (labels to data/labels/val)")
+        print(f"   and set 'val: images/val' in {CONFIG['data_yaml']}")
+        return
+    
+    # Replay sampling: mix previously seen images in with the new ones
+    replay_count = min(len(unchanged), int(len(changed) * CONFIG['replay_ratio']))
+    replay = random.sample(unchanged, replay_count)
+    
+    update_dir = Path(CONFIG['save_dir']) / 'update'
+    update_dir.mkdir(parents=True, exist_ok=True)
+    train_list = update_dir / 'train.txt'
+    train_list.write_text('\n'.join(str((root / key).resolve()) for key in changed + replay) + '\n')
+    
+    update_config = dict(data_config)
+    update_config['path'] = str(root.resolve())
+    update_config['train'] = str(train_list.resolve())
+    update_yaml = update_dir / 'data.yaml'
+    with open(update_yaml, 'w') as f:
+        yaml.dump(update_config, f, default_flow_style=False)
+    
+    # Baseline on the full validation set before touching anything
+    baseline = validate_model(production_model)
+    
+    print(f"\n📦 Fine-tuning {production_model} on {len(changed)} new + {replay_count} replayed images")
+    print(f"   - Epochs: {CONFIG['update_epochs']}")
+    print(f"   - Learning rate: {CONFIG['update_lr0']}")
+    
+    try:
+        model = YOLO(production_model)
+        model.train(
+            data=str(update_yaml),
+            epochs=CONFIG['update_epochs'],
+            batch=CONFIG['batch_size'],
+            imgsz=CONFIG['img_size'],
+            device=CONFIG['device'],
+            project=CONFIG['save_dir'],
+            name='kidney_stone_yolov8_update',
+            exist_ok=True,
+            
+            # Same augmentation as full training
+            augment=True,
+            hsv_h=0.015,
+            hsv_s=0.7,
+            hsv_v=0.4,
+            degrees=10.0,
+            translate=0.1,
+            scale=0.5,
+            flipud=0.5,
+            fliplr=0.5,
+            mosaic=1.0,
+            
+            # Gentle fine-tuning schedule
+            optimizer='AdamW',
+            lr0=CONFIG['update_lr0'],
+            lrf=0.1,
+            weight_decay=0.0005,
+            warmup_epochs=0,
+            
+            val=True,
+            verbose=True,
+        )
+    except Exception as e:
+        print(f"\n❌ Update training failed: {e}")
+        return
+    
+    candidate = Path(CONFIG['save_dir']) / 'kidney_stone_yolov8_update' / 'weights' / 'best.pt'
+    candidate_results = validate_model(str(candidate))
+    if candidate_results is None:
+        return
+    
+    # Promotion gate: no regression on any headline metric
+    metrics = [
+        ('mAP50', baseline.box.map50, candidate_results.box.map50),
+        ('mAP50-95', baseline.box.map, candidate_results.box.map),
+        ('Precision', baseline.box.mp, candidate_results.box.mp),
+        ('Recall', baseline.box.mr, candidate_results.box.mr),
+    ]
+    
+    print(f"\n📈 Production vs Candidate:")
+    regressed = []
+    for name, before, after in metrics:
+        print(f"   - {name}: {before:.4f} -> {after:.4f}")
+        if after < before - CONFIG['update_tolerance']:
+            regressed.append(name)
+    
+    if regressed:
+        print(f"\n❌ Not promoted: {', '.join(regressed)} regressed")
+        print(f"   Candidate kept at {candidate}")
+        print(f"   New data stays pending and will be included in the next update")
+        return
+    
+    backup = Path(production_model).with_suffix('.prev.pt')
+    shutil.copy(production_model, backup)
+    shutil.copy(candidate, production_model)
+    save_manifest(current)
+    
+    print(f"\n✅ Promoted {candidate} to {production_model}")
+    print(f"   Previous weights backed up to {backup}")
+    print(f"   Restart backend to load the new model: python app.py")
 
 def test_inference(model_path='../models/kidney_stone_yolov8.pt', test_image='../data/test_images/sample.jpg'):
     """Test model on a single image"""
@@ -199,17 +512,25 @@ if __name__ == '__main__':
             train_model()
         elif command == 'validate':
             validate_model()
+        elif command == 'update':
+            update_model(baseline='--baseline' in sys.argv)
+        elif command == 'promote':
+            promote_model()
         elif command == 'test':
             test_image = sys.argv[2] if len(sys.argv) > 2 else '../data/test_images/sample.jpg'
             test_inference(test_image=test_image)
         else:
             print(f"Unknown command: {command}")
-            print("Usage: python train.py [train|validate|test]")
+            print("Usage: python train.py [train|validate|promote|update|test]")
     else:
         print("YOLOv8 Kidney Stone Training Script")
         print("\nUsage:")
         print("  python train.py train          - Train new model")
         print("  python train.py validate       - Validate trained model")
+        print("  python train.py promote        - Deploy the last full training run")
+        print("  python train.py update         - Fine-tune on new/changed labels")
+        print("  python train.py update --baseline")
+        print("                                 - Record current data as already trained")
         print("  python train.py test [image]   - Test on single image")
         print("\nRunning training by default...")
         train_model()
\ No newline at end of file